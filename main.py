@@ -1,129 +1,356 @@
 import os
 import json
+import asyncio
+import time
+import calendar
+import tempfile
+import stat
 import logging
-from datetime import datetime, timezone, timedelta
+import logging.handlers
+import queue
+import functools
+from datetime import datetime, timezone
 from pathlib import Path
 
+import aiohttp
 import discord
-from discord.ext import tasks
-from dotenv import load_dotenv
+from discord.utils import sleep_until
 
-load_dotenv()
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s: %(message)s')
+# Only parse .env when the token isn't already in the environment
+if not os.environ.get("DISCORD_BOT_TOKEN"):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# Records are queued on the event loop and written to stderr by a listener thread
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+
+logging.basicConfig(
+    level=logging.ERROR,
+    format='%(asctime)s - %(levelname)s: %(message)s',
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
+)
 logger = logging.getLogger("holiday_bot")
 
+# os.umask can only be read by setting it, so do that once before any threads
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Holiday messages are deleted this long after being sent
+DELETE_AFTER_SECONDS = 86400
+
+
+def _read_json(path: Path):
+    """Parse a JSON file, using orjson when available"""
+    if orjson:
+        return orjson.loads(path.read_bytes())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_json(path: Path, data):
+    """Atomically write data to a JSON file, using orjson when available"""
+    payload = orjson.dumps(data) if orjson else json.dumps(data).encode('utf-8')
+    
+    # Keep the target's mode; NamedTemporaryFile would otherwise leave it 0600
+    try:
+        mode = stat.S_IMODE(path.stat().st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    
+    # Write and fsync next to the target, then swap it in, so a crash or
+    # power loss leaves either the old or the new contents
+    tmp = tempfile.NamedTemporaryFile('wb', dir=path.parent, suffix='.tmp', delete=False)
+    try:
+        with tmp:
+            tmp.write(payload)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.chmod(tmp.name, mode)
+        os.replace(tmp.name, path)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+
+@functools.lru_cache(maxsize=512)
+def _holiday_ts(year: int, month: int, day: int, hour: int, minute: int):
+    """UTC timestamp of a send time, or None if the date doesn't exist that year"""
+    if day > calendar.monthrange(year, month)[1]:
+        return None
+    return calendar.timegm((year, month, day, hour, minute, 0))
+
+
 # Minimal intents
 intents = discord.Intents.none()
 intents.guilds = True
-intents.messages = True
 
 
 class HolidayBot(discord.Client):
     """Minimal bot to send and auto-delete holiday messages"""
     
-    __slots__ = ('_config', '_config_path', '_sent_today')
+    __slots__ = (
+        '_config', '_config_path', '_holidays', '_holiday_dates',
+        '_target_time', '_scheduler_task',
+        '_pending_path', '_pending_deletes', '_channel'
+    )
     
     def __init__(self):
         super().__init__(
             intents=intents,
             chunk_guilds_at_startup=False,
-            max_messages=0
+            max_messages=None
         )
         
         self._config_path = Path("config.json")
         self._config = self._load_config()
-        self._sent_today = set()
+        
+        # Parse and check the schedule once, so the scheduler never sees bad dates
+        self._holidays = self._parse_holidays(self._config["holiday_messages"])
+        self._holiday_dates = sorted(self._holidays)
+        self._target_time = self._parse_target_time(self._config["message_time_utc"])
+        self._scheduler_task = None
+        self._channel = None
+        
+        # (channel_id, message_id, expires_at) of messages still to delete
+        self._pending_path = Path("pending_deletes.json")
+        self._pending_deletes = self._load_pending()
     
     def _load_config(self) -> dict:
         """Load config file"""
         try:
-            with open(self._config_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return _read_json(self._config_path)
         except FileNotFoundError:
             logger.error("config.json not found!")
             raise
         except Exception as e:
-            logger.error(f"Config error: {e}")
+            logger.error("Config error: %s", e)
             raise
     
-    async def setup_hook(self):
-        """Start background task"""
-        self.check_and_send.start()
+    def _parse_holidays(self, messages: dict) -> dict:
+        """Parse "M-D" keys into (month, day) -> text, dropping invalid dates"""
+        holidays = {}
+        for key, text in messages.items():
+            try:
+                month, day = map(int, key.split('-'))
+            except ValueError:
+                month = day = 0
+            
+            # 2000 is a leap year, so 2-29 passes here and is skipped per year later
+            if not (1 <= month <= 12 and 1 <= day <= calendar.monthrange(2000, month)[1]):
+                logger.error("Ignoring invalid holiday date: %r", key)
+                continue
+            holidays[(month, day)] = text
+        return holidays
     
-    async def on_ready(self):
-        """Bot is ready"""
-        logger.info(f"Bot ready: {self.user}")
-        
-        # Validate channel exists
-        channel = self.get_channel(self._config["channel_id"])
-        if not channel:
-            logger.error(f"Channel {self._config['channel_id']} not found!")
+    def _parse_target_time(self, send_time: dict) -> tuple:
+        """Return (hour, minute) from message_time_utc, checking the ranges"""
+        hour, minute = send_time["hour"], send_time["minute"]
+        if not (
+            type(hour) is int and 0 <= hour <= 23
+            and type(minute) is int and 0 <= minute <= 59
+        ):
+            logger.error("Invalid message_time_utc: %r:%r", hour, minute)
+            raise ValueError("message_time_utc needs hour 0-23 and minute 0-59")
+        return hour, minute
     
-    @tasks.loop(minutes=1)
-    async def check_and_send(self):
-        """Check if it's time to send a holiday message"""
-        await self.wait_until_ready()
+    def _load_pending(self) -> list:
+        """Load deletions left over from the previous run"""
+        try:
+            data = _read_json(self._pending_path)
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            logger.error("Pending deletes error: %s", e)
+            return []
         
-        now = datetime.now(timezone.utc)
-        date_key = f"{now.month}-{now.day}"
+        if not isinstance(data, list):
+            logger.error("Ignoring malformed pending deletes file")
+            return []
         
-        # Reset tracking at midnight
-        if now.hour == 0 and now.minute == 0:
-            self._sent_today.clear()
+        # Keep only (channel_id, message_id, expires_at) entries
+        pending = []
+        for entry in data:
+            if (
+                isinstance(entry, list) and len(entry) == 3
+                and all(type(v) is int for v in entry[:2])
+                and type(entry[2]) in (int, float)
+            ):
+                pending.append(tuple(entry))
+            else:
+                logger.error("Dropping malformed pending delete: %r", entry)
+        return pending
+    
+    async def _save_pending(self):
+        """Write pending deletions to disk without blocking the event loop"""
+        try:
+            await asyncio.to_thread(
+                _write_json, self._pending_path, list(self._pending_deletes)
+            )
+        except OSError as e:
+            logger.error("Failed to save pending deletes: %s", e)
+    
+    async def setup_hook(self):
+        """Re-arm pending deletions and start background task"""
+        # No fetch needed: a partial message is enough to delete by id
+        now = time.time()
+        for channel_id, message_id, expires_at in self._pending_deletes:
+            channel = self.get_partial_messageable(channel_id)
+            message = channel.get_partial_message(message_id)
+            await message.delete(delay=max(0, expires_at - now))
         
-        # Skip if already sent today
-        if date_key in self._sent_today:
-            return
+        # Overdue ones are being deleted right now, so stop tracking them
+        pending = [entry for entry in self._pending_deletes if entry[2] > now]
+        if len(pending) != len(self._pending_deletes):
+            self._pending_deletes = pending
+            await self._save_pending()
         
-        # Check if today is a holiday
-        message_text = self._config["holiday_messages"].get(date_key)
-        if not message_text:
-            return
+        self._scheduler_task = asyncio.create_task(self._scheduler())
+    
+    async def on_ready(self):
+        """Bot is ready"""
+        logger.info("Bot ready: %s", self.user)
+        
+        # Resolve and type-check the channel once, then keep it
+        self._channel = self._usable_channel(
+            self.get_channel(self._config["channel_id"])
+        )
+    
+    def _usable_channel(self, channel):
+        """Return channel if messages can be sent to it, else None"""
+        if channel is None:
+            logger.error("Channel %s not found!", self._config["channel_id"])
+            return None
+        if not isinstance(channel, discord.abc.Messageable):
+            logger.error(
+                "Channel %s is a %s, which can't receive messages!",
+                self._config["channel_id"], type(channel).__name__
+            )
+            return None
+        return channel
+    
+    async def on_guild_channel_update(self, before, after):
+        """Keep the cached channel current"""
+        if after.id == self._config["channel_id"]:
+            self._channel = self._usable_channel(after)
+    
+    async def on_guild_channel_delete(self, channel):
+        """Forget the cached channel once it is gone"""
+        if channel.id == self._config["channel_id"]:
+            self._channel = None
+    
+    def _next_send_time(self, now: float):
+        """Return (timestamp, date) of the first holiday send after now, or None"""
+        hour, minute = self._target_time
         
-        # Check if it's the right time (within 1 minute window)
-        target_hour = self._config["message_time_utc"]["hour"]
-        target_minute = self._config["message_time_utc"]["minute"]
+        # Look a few years ahead so a lone 2-29 still gets scheduled
+        first_year = time.gmtime(now).tm_year
+        for year in range(first_year, first_year + 5):
+            for month, day in self._holiday_dates:
+                target = _holiday_ts(year, month, day, hour, minute)
+                if target is not None and target > now:
+                    return target, (month, day)
+        return None
+    
+    async def _scheduler(self):
+        """Sleep until the next holiday send time, then send"""
+        await self.wait_until_ready()
         
-        if now.hour != target_hour or now.minute != target_minute:
-            return
+        last_sent = 0
+        while not self.is_closed():
+            # Never pick the same target twice if the sleep woke early
+            upcoming = self._next_send_time(max(time.time(), last_sent))
+            if upcoming is None:
+                logger.error("No holiday dates configured")
+                return
+            
+            target, date = upcoming
+            when = datetime.fromtimestamp(target, timezone.utc)
+            
+            # The sleep is measured on the monotonic clock, so a wall-clock
+            # step backwards can end it early; sleep off the remainder
+            while time.time() < target:
+                await sleep_until(when)
+            
+            # A suspended host can wake us after the holiday is over
+            now = time.gmtime()
+            if (now.tm_mon, now.tm_mday) != date:
+                logger.error("Missed holiday %d-%d, woke too late", *date)
+            else:
+                # Keep the scheduler alive for next holiday whatever happens here
+                try:
+                    await self._send_holiday(date)
+                except (OSError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.error("Network error sending %d-%d: %s", *date, e)
+                except Exception:
+                    logger.exception("Unexpected error sending %d-%d", *date)
+            last_sent = target
+    
+    async def _send_with_retry(self, channel, content: str, attempts: int = 3):
+        """Send content, waiting out 429s that outlast discord.py's own retries"""
+        for attempt in range(attempts):
+            try:
+                return await channel.send(content)
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == attempts - 1:
+                    raise
+                retry_after = float(e.response.headers.get("Retry-After", 1.0))
+                await asyncio.sleep(retry_after + 0.25)
+    
+    async def _send_holiday(self, date: tuple):
+        """Send the holiday message for a (month, day) date"""
+        message_text = self._holidays[date]
         
-        # Send the message
-        channel = self.get_channel(self._config["channel_id"])
+        channel = self._channel
         if not channel:
             logger.error("Channel not found")
             return
         
         try:
-            message = await channel.send(message_text)
-            self._sent_today.add(date_key)
-            logger.info(f"Sent: {date_key}")
+            message = await self._send_with_retry(channel, message_text)
+            logger.info("Sent: %d-%d", *date)
+            
+            # Delete after 24 hours, remembering it in case we restart first
+            await message.delete(delay=DELETE_AFTER_SECONDS)
             
-            # Delete after 24 hours
-            await message.delete(delay=86400)  # 24 hours = 86400 seconds
+            now = time.time()
+            self._pending_deletes = [
+                entry for entry in self._pending_deletes if entry[2] > now
+            ]
+            self._pending_deletes.append(
+                (channel.id, message.id, now + DELETE_AFTER_SECONDS)
+            )
+            await self._save_pending()
             
         except discord.Forbidden:
             logger.error("No permission to send/delete messages")
         except discord.HTTPException as e:
-            logger.error(f"Failed to send message: {e}")
+            logger.error("Failed to send message: %s", e)
 
 
 def main():
     """Run the bot"""
-    token = os.getenv("DISCORD_BOT_TOKEN")
+    token = os.environ.get("DISCORD_BOT_TOKEN")
     
     if not token:
         print("ERROR: DISCORD_BOT_TOKEN not found in .env")
         return
     
-    bot = HolidayBot()
-    
+    _log_listener.start()
     try:
+        bot = HolidayBot()
         bot.run(token, log_handler=None, log_level=logging.CRITICAL)
     except discord.LoginFailure:
         print("ERROR: Invalid token")
     except KeyboardInterrupt:
         print("\nStopped")
+    finally:
+        _log_listener.stop()
 
 
 if __name__ == "__main__":